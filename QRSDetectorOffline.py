@@ -1,13 +1,101 @@
+import os
+import tempfile
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from time import gmtime, strftime
-from scipy.signal import butter, lfilter
+from numba import njit
+from scipy.signal import butter, sosfilt
 
 
 LOG_DIR = "logs/"
 PLOT_DIR = "plots/"
 
 
+@njit(cache=True, fastmath=True)
+def _pan_tompkins_integrate(data, window):
+    """
+    Fused derivative, squaring and moving-window integration of the filtered ECG measurements.
+    Computes the same values as np.convolve(np.ediff1d(data) ** 2, np.ones(window)) in a single pass,
+    keeping only the last `window` squared derivative values in a circular buffer.
+    :param ndarray data: filtered ECG measurements
+    :param int window: integration window width (in samples)
+    :return array: integrated measurements
+    """
+    derivative_len = data.size - 1
+    integrated = np.empty(derivative_len + window - 1, dtype=data.dtype)
+    squared_buffer = np.zeros(window, dtype=data.dtype)
+    running_sum = 0.0
+    for i in range(integrated.size):
+        squared = 0.0
+        if i < derivative_len:
+            derivative = data[i + 1] - data[i]
+            squared = derivative * derivative
+        buffer_index = i % window
+        running_sum += squared - squared_buffer[buffer_index]
+        squared_buffer[buffer_index] = squared
+        integrated[i] = running_sum
+    return integrated
+
+
+@njit(cache=True)
+def _classify_peaks(peaks_indices, peaks_values, refractory_period, qrs_peak_filtering_factor,
+                    noise_peak_filtering_factor, qrs_noise_diff_weight, qrs_peak_value, noise_peak_value,
+                    threshold_value):
+    """
+    Classification of detected peaks either as noise or as QRS complex (heart beat) with dynamically adjusted threshold.
+    :param ndarray peaks_indices: detected peaks indices
+    :param ndarray peaks_values: detected peaks values
+    :param int refractory_period: minimum distance between consecutive QRS complexes (in samples)
+    :param float qrs_peak_filtering_factor: QRS peak value filtering factor
+    :param float noise_peak_filtering_factor: noise peak value filtering factor
+    :param float qrs_noise_diff_weight: QRS-noise difference weight used for setting threshold value
+    :param float qrs_peak_value: initial QRS peak value
+    :param float noise_peak_value: initial noise peak value
+    :param float threshold_value: initial QRS-noise threshold value
+    :return tuple: QRS peaks indices, noise peaks indices and final QRS peak, noise peak and threshold values
+    """
+    qrs_peaks_indices = np.empty(peaks_indices.size, dtype=np.int64)
+    noise_peaks_indices = np.empty(peaks_indices.size, dtype=np.int64)
+    qrs_peaks_count = 0
+    noise_peaks_count = 0
+    # Last QRS index is initialised a refractory period before the first sample, so that no peak is rejected before
+    # the first QRS complex is detected.
+    last_qrs_index = -refractory_period - 1
+
+    for i in range(peaks_indices.size):
+        detected_peak_index = peaks_indices[i]
+        detected_peaks_value = peaks_values[i]
+
+        # After a valid QRS complex detection, there is a 200 ms refractory period before next one can be detected.
+        if detected_peak_index - last_qrs_index > refractory_period:
+            # Peak must be classified either as a noise peak or a QRS peak.
+            # To be classified as a QRS peak it must exceed dynamically set threshold value.
+            if detected_peaks_value > threshold_value:
+                qrs_peaks_indices[qrs_peaks_count] = detected_peak_index
+                qrs_peaks_count += 1
+                last_qrs_index = detected_peak_index
+
+                # Adjust QRS peak value used later for setting QRS-noise threshold.
+                qrs_peak_value = qrs_peak_filtering_factor * detected_peaks_value + \
+                                 (1 - qrs_peak_filtering_factor) * qrs_peak_value
+            else:
+                noise_peaks_indices[noise_peaks_count] = detected_peak_index
+                noise_peaks_count += 1
+
+                # Adjust noise peak value used later for setting QRS-noise threshold.
+                noise_peak_value = noise_peak_filtering_factor * detected_peaks_value + \
+                                   (1 - noise_peak_filtering_factor) * noise_peak_value
+
+            # Adjust QRS-noise threshold value based on previously detected QRS or noise peaks value.
+            threshold_value = noise_peak_value + qrs_noise_diff_weight * (qrs_peak_value - noise_peak_value)
+
+    return qrs_peaks_indices[:qrs_peaks_count], noise_peaks_indices[:noise_peaks_count], \
+        qrs_peak_value, noise_peak_value, threshold_value
+
+
 class QRSDetectorOffline(object):
     """
     Python Offline ECG QRS Detector based on the Pan-Tomkins algorithm.
@@ -86,13 +174,15 @@ class QRSDetectorOffline(object):
         self.noise_peak_filtering_factor = 0.125
         self.qrs_noise_diff_weight = 0.25
 
+        # Band pass filter depends only on configuration parameters, so it is designed once.
+        self.filter_sos = self.design_bandpass_filter(lowcut=self.filter_lowcut, highcut=self.filter_highcut,
+                                                      signal_freq=self.signal_frequency, filter_order=self.filter_order)
+
         # Loaded ECG data.
         self.ecg_data_raw = None
 
         # Measured and calculated values.
         self.filtered_ecg_measurements = None
-        self.differentiated_ecg_measurements = None
-        self.squared_ecg_measurements = None
         self.integrated_ecg_measurements = None
         self.detected_peaks_indices = None
         self.detected_peaks_values = None
@@ -126,13 +216,59 @@ class QRSDetectorOffline(object):
                                                                              strftime("%Y_%m_%d_%H_%M_%S", gmtime()))
             self.plot_detection_data(show_plot=show_plot)
 
+    """Batch processing methods."""
+
+    @classmethod
+    def process_batch(cls, ecg_data_paths, max_workers=None, verbose=False):
+        """
+        Method running QRS detection on multiple ECG datasets in parallel, each dataset in a separate process.
+        Must be called under `if __name__ == "__main__":` guard, as worker processes started with spawn method import
+        the calling module again.
+        :param list ecg_data_paths: paths to the ECG datasets
+        :param int max_workers: maximum number of worker processes - defaults to the number of processors
+        :param bool verbose: flag for printing the results
+        :return list: QRSDetectorOffline objects with detection results, in order of given paths
+        """
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(partial(cls, verbose=verbose), ecg_data_paths))
+
     """Loading ECG measurements data methods."""
 
     def load_ecg_data(self):
         """
         Method loading ECG data set from a file.
+        Loaded data set is cached in binary .npy format next to the file and memory-mapped on subsequent runs.
         """
-        self.ecg_data_raw = np.loadtxt(self.ecg_data_path, skiprows=1, delimiter=',')
+        cache_path = os.fspath(self.ecg_data_path) + ".npy"
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(self.ecg_data_path):
+            # Unreadable or corrupted cache is ignored - data set is parsed again and the cache is rewritten then.
+            try:
+                self.ecg_data_raw = np.load(cache_path, mmap_mode="r")
+                return
+            except (OSError, ValueError):
+                pass
+
+        # Only timestamp and measurement columns are used - any additional columns in the file are skipped.
+        self.ecg_data_raw = pd.read_csv(self.ecg_data_path, skiprows=1, header=None, usecols=[0, 1],
+                                        dtype=np.float64).to_numpy()
+
+        # Cache is written to a temporary file and moved in place, so that concurrent runs never load a partially
+        # written cache. Data set directory may be read-only - loaded data is used without caching then.
+        try:
+            cache_file_descriptor, cache_temp_path = tempfile.mkstemp(suffix=".npy",
+                                                                      dir=os.path.dirname(os.path.abspath(cache_path)))
+        except OSError:
+            return
+        try:
+            with os.fdopen(cache_file_descriptor, "wb") as cache_file:
+                np.save(cache_file, self.ecg_data_raw)
+            # Temporary file is created readable only by its owner - cache gets default new file permissions instead.
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(cache_temp_path, 0o666 & ~umask)
+            os.replace(cache_temp_path, cache_path)
+        except OSError:
+            os.remove(cache_temp_path)
 
     """ECG measurements data processing methods."""
 
@@ -144,19 +280,14 @@ class QRSDetectorOffline(object):
         ecg_measurements = self.ecg_data_raw[:, 1]
 
         # Measurements filtering - 0-15 Hz band pass filter.
-        self.filtered_ecg_measurements = self.bandpass_filter(ecg_measurements, lowcut=self.filter_lowcut,
-                                                              highcut=self.filter_highcut, signal_freq=self.signal_frequency,
-                                                              filter_order=self.filter_order)
+        # Filter runs in double precision, all further processing is done in single precision.
+        self.filtered_ecg_measurements = self.bandpass_filter(ecg_measurements).astype(np.float32, copy=False)
         self.filtered_ecg_measurements[:5] = self.filtered_ecg_measurements[5]
 
-        # Derivative - provides QRS slope information.
-        self.differentiated_ecg_measurements = np.ediff1d(self.filtered_ecg_measurements)
-
-        # Squaring - intensifies values received in derivative.
-        self.squared_ecg_measurements = self.differentiated_ecg_measurements ** 2
-
-        # Moving-window integration.
-        self.integrated_ecg_measurements = np.convolve(self.squared_ecg_measurements, np.ones(self.integration_window))
+        # Derivative (QRS slope information), squaring (intensifies derivative values) and moving-window integration
+        # computed in a single pass.
+        self.integrated_ecg_measurements = _pan_tompkins_integrate(self.filtered_ecg_measurements,
+                                                                   self.integration_window)
 
         # Fiducial mark - peak detection on integrated measurements.
         self.detected_peaks_indices = self.findpeaks(data=self.integrated_ecg_measurements,
@@ -171,33 +302,15 @@ class QRSDetectorOffline(object):
         """
         Method responsible for classifying detected ECG measurements peaks either as noise or as QRS complex (heart beat).
         """
-        for detected_peak_index, detected_peaks_value in zip(self.detected_peaks_indices, self.detected_peaks_values):
-
-            try:
-                last_qrs_index = self.qrs_peaks_indices[-1]
-            except IndexError:
-                last_qrs_index = 0
-
-            # After a valid QRS complex detection, there is a 200 ms refractory period before next one can be detected.
-            if detected_peak_index - last_qrs_index > self.refractory_period or not self.qrs_peaks_indices.size:
-                # Peak must be classified either as a noise peak or a QRS peak.
-                # To be classified as a QRS peak it must exceed dynamically set threshold value.
-                if detected_peaks_value > self.threshold_value:
-                    self.qrs_peaks_indices = np.append(self.qrs_peaks_indices, detected_peak_index)
-
-                    # Adjust QRS peak value used later for setting QRS-noise threshold.
-                    self.qrs_peak_value = self.qrs_peak_filtering_factor * detected_peaks_value + \
-                                          (1 - self.qrs_peak_filtering_factor) * self.qrs_peak_value
-                else:
-                    self.noise_peaks_indices = np.append(self.noise_peaks_indices, detected_peak_index)
-
-                    # Adjust noise peak value used later for setting QRS-noise threshold.
-                    self.noise_peak_value = self.noise_peak_filtering_factor * detected_peaks_value + \
-                                            (1 - self.noise_peak_filtering_factor) * self.noise_peak_value
-
-                # Adjust QRS-noise threshold value based on previously detected QRS or noise peaks value.
-                self.threshold_value = self.noise_peak_value + \
-                                       self.qrs_noise_diff_weight * (self.qrs_peak_value - self.noise_peak_value)
+        self.qrs_peaks_indices, self.noise_peaks_indices, self.qrs_peak_value, self.noise_peak_value, \
+            self.threshold_value = _classify_peaks(self.detected_peaks_indices, self.detected_peaks_values,
+                                                   refractory_period=self.refractory_period,
+                                                   qrs_peak_filtering_factor=self.qrs_peak_filtering_factor,
+                                                   noise_peak_filtering_factor=self.noise_peak_filtering_factor,
+                                                   qrs_noise_diff_weight=self.qrs_noise_diff_weight,
+                                                   qrs_peak_value=self.qrs_peak_value,
+                                                   noise_peak_value=self.noise_peak_value,
+                                                   threshold_value=self.threshold_value)
 
         # Create array containing both input ECG measurements data and QRS detection indication column.
         # We mark QRS detection with '1' flag in 'qrs_detected' log column ('0' otherwise).
@@ -237,13 +350,17 @@ class QRSDetectorOffline(object):
         def plot_points(axis, values, indices):
             axis.scatter(x=indices, y=values[indices], c="black", s=50, zorder=2)
 
+        # Intermediate processing stages are not kept by the fused integration, recompute them for plotting only.
+        differentiated_ecg_measurements = np.ediff1d(self.filtered_ecg_measurements)
+        squared_ecg_measurements = differentiated_ecg_measurements ** 2
+
         plt.close('all')
         fig, axarr = plt.subplots(6, sharex=True, figsize=(15, 18))
 
         plot_data(axis=axarr[0], data=self.ecg_data_raw[:, 1], title='Raw ECG measurements')
         plot_data(axis=axarr[1], data=self.filtered_ecg_measurements, title='Filtered ECG measurements')
-        plot_data(axis=axarr[2], data=self.differentiated_ecg_measurements, title='Differentiated ECG measurements')
-        plot_data(axis=axarr[3], data=self.squared_ecg_measurements, title='Squared ECG measurements')
+        plot_data(axis=axarr[2], data=differentiated_ecg_measurements, title='Differentiated ECG measurements')
+        plot_data(axis=axarr[3], data=squared_ecg_measurements, title='Squared ECG measurements')
         plot_data(axis=axarr[4], data=self.integrated_ecg_measurements, title='Integrated ECG measurements with QRS peaks marked (black)')
         plot_points(axis=axarr[4], values=self.integrated_ecg_measurements, indices=self.qrs_peaks_indices)
         plot_data(axis=axarr[5], data=self.ecg_data_detected[:, 1], title='Raw ECG measurements with QRS peaks marked (black)')
@@ -259,21 +376,27 @@ class QRSDetectorOffline(object):
 
     """Tools methods."""
 
-    def bandpass_filter(self, data, lowcut, highcut, signal_freq, filter_order):
+    def design_bandpass_filter(self, lowcut, highcut, signal_freq, filter_order):
         """
-        Method responsible for creating and applying Butterworth filter.
-        :param deque data: raw data
+        Method responsible for creating Butterworth filter.
         :param float lowcut: filter lowcut frequency value
         :param float highcut: filter highcut frequency value
         :param int signal_freq: signal frequency in samples per second (Hz)
         :param int filter_order: filter order
-        :return array: filtered data
+        :return array: filter second-order sections
         """
         nyquist_freq = 0.5 * signal_freq
         low = lowcut / nyquist_freq
         high = highcut / nyquist_freq
-        b, a = butter(filter_order, [low, high], btype="band")
-        y = lfilter(b, a, data)
+        return butter(filter_order, [low, high], btype="band", output="sos")
+
+    def bandpass_filter(self, data):
+        """
+        Method responsible for applying Butterworth filter.
+        :param deque data: raw data
+        :return array: filtered data
+        """
+        y = sosfilt(self.filter_sos, data)
         return y
 
     def findpeaks(self, data, spacing=1, limit=None):
@@ -287,23 +410,19 @@ class QRSDetectorOffline(object):
         :return array: detected peaks indexes array
         """
         len = data.size
-        x = np.zeros(len + 2 * spacing)
-        x[:spacing] = data[0] - 1.e-6
-        x[-spacing:] = data[-1] - 1.e-6
-        x[spacing:spacing + len] = data
-        peak_candidate = np.zeros(len)
-        peak_candidate[:] = True
-        for s in range(spacing):
-            start = spacing - s - 1
-            h_b = x[start: start + len]  # before
-            start = spacing
-            h_c = x[start: start + len]  # central
-            start = spacing + s + 1
-            h_a = x[start: start + len]  # after
-            peak_candidate = np.logical_and(peak_candidate, np.logical_and(h_c > h_b, h_c > h_a))
-
-        ind = np.argwhere(peak_candidate)
-        ind = ind.reshape(ind.size)
+        # Samples closer than `spacing` to data edges are compared with border values just below the edge samples.
+        peak_candidate = np.ones(len, dtype=bool)
+        peak_candidate[:spacing] = data[:spacing] > data[0] - 1.e-6
+        peak_candidate[-spacing:] &= data[-spacing:] > data[-1] - 1.e-6
+        greater_before = np.empty(len, dtype=bool)
+        greater_after = np.empty(len, dtype=bool)
+        for s in range(1, spacing + 1):
+            np.greater(data[s:], data[:-s], out=greater_before[s:])  # central vs before
+            np.greater(data[:-s], data[s:], out=greater_after[:-s])  # central vs after
+            np.logical_and(peak_candidate[s:], greater_before[s:], out=peak_candidate[s:])
+            np.logical_and(peak_candidate[:-s], greater_after[:-s], out=peak_candidate[:-s])
+
+        ind = np.flatnonzero(peak_candidate)
         if limit is not None:
             ind = ind[data[ind] > limit]
         return ind
@@ -1,7 +1,7 @@
 import numpy as np
 from collections import deque
 from time import gmtime, strftime
-from scipy.signal import butter, lfilter
+from scipy.signal import butter, sosfilt
 
 LOG_DIR = "logs/"
 
@@ -83,6 +83,10 @@ class QRSDetectorOnline(object):
         self.noise_peak_filtering_factor = 0.125
         self.qrs_noise_diff_weight = 0.25
 
+        # Band pass filter depends only on configuration parameters, so it is designed once.
+        self.filter_sos = self.design_bandpass_filter(lowcut=self.filter_lowcut, highcut=self.filter_highcut,
+                                                      signal_freq=self.signal_frequency, filter_order=self.filter_order)
+
         # Measurements and calculated values.
         self.timestamp = 0
         self.measurement = 0
@@ -157,15 +161,13 @@ class QRSDetectorOnline(object):
         :param deque most_recent_measurements: most recent ECG measurements array
         """
         # Measurements filtering - 0-15 Hz band pass filter.
-        filtered_ecg_measurements = self.bandpass_filter(most_recent_measurements, lowcut=self.filter_lowcut,
-                                                         highcut=self.filter_highcut, signal_freq=self.signal_frequency,
-                                                         filter_order=self.filter_order)
+        filtered_ecg_measurements = self.bandpass_filter(most_recent_measurements)
 
         # Derivative - provides QRS slope information.
-        differentiated_ecg_measurements = np.ediff1d(filtered_ecg_measurements)
+        differentiated_ecg_measurements = np.diff(filtered_ecg_measurements)
 
-        # Squaring - intensifies values received in derivative.
-        squared_ecg_measurements = differentiated_ecg_measurements ** 2
+        # Squaring - intensifies values received in derivative (in place, derivative values are not used afterwards).
+        squared_ecg_measurements = np.square(differentiated_ecg_measurements, out=differentiated_ecg_measurements)
 
         # Moving-window integration.
         integrated_ecg_measurements = np.convolve(squared_ecg_measurements, np.ones(self.integration_window))
@@ -236,22 +238,27 @@ class QRSDetectorOnline(object):
         with open(path, "a") as fin:
             fin.write(data)
 
-    def bandpass_filter(self, data, lowcut, highcut, signal_freq, filter_order):
+    def design_bandpass_filter(self, lowcut, highcut, signal_freq, filter_order):
         """
-        Method responsible for creating and applying Butterworth filter.
-        :param deque data: raw data
+        Method responsible for creating Butterworth filter.
         :param float lowcut: filter lowcut frequency value
         :param float highcut: filter highcut frequency value
         :param int signal_freq: signal frequency in samples per second (Hz)
         :param int filter_order: filter order
-        :return array: filtered data
+        :return array: filter second-order sections
         """
-        """Constructs signal filter and uses it to given data set."""
         nyquist_freq = 0.5 * signal_freq
         low = lowcut / nyquist_freq
         high = highcut / nyquist_freq
-        b, a = butter(filter_order, [low, high], btype="band")
-        y = lfilter(b, a, data)
+        return butter(filter_order, [low, high], btype="band", output="sos")
+
+    def bandpass_filter(self, data):
+        """
+        Method responsible for applying Butterworth filter.
+        :param deque data: raw data
+        :return array: filtered data
+        """
+        y = sosfilt(self.filter_sos, data)
         return y
 
     def findpeaks(self, data, spacing=1, limit=None):
@@ -269,8 +276,9 @@ class QRSDetectorOnline(object):
         x[:spacing] = data[0] - 1.e-6
         x[-spacing:] = data[-1] - 1.e-6
         x[spacing:spacing + len] = data
-        peak_candidate = np.zeros(len)
-        peak_candidate[:] = True
+        peak_candidate = np.ones(len, dtype=bool)
+        greater_before = np.empty(len, dtype=bool)
+        greater_after = np.empty(len, dtype=bool)
         for s in range(spacing):
             start = spacing - s - 1
             h_b = x[start: start + len]  # before
@@ -278,10 +286,12 @@ class QRSDetectorOnline(object):
             h_c = x[start: start + len]  # central
             start = spacing + s + 1
             h_a = x[start: start + len]  # after
-            peak_candidate = np.logical_and(peak_candidate, np.logical_and(h_c > h_b, h_c > h_a))
+            np.greater(h_c, h_b, out=greater_before)
+            np.greater(h_c, h_a, out=greater_after)
+            np.logical_and(peak_candidate, greater_before, out=peak_candidate)
+            np.logical_and(peak_candidate, greater_after, out=peak_candidate)
 
-        ind = np.argwhere(peak_candidate)
-        ind = ind.reshape(ind.size)
+        ind = np.flatnonzero(peak_candidate)
         if limit is not None:
             ind = ind[data[ind] > limit]
         return ind